@@ -1,14 +1,17 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
+import asyncio
+from collections import OrderedDict
 import httpx
-from groq import Groq
+from groq import AsyncGroq
 import os
 from dotenv import load_dotenv
-from piper import PiperVoice
-import io
-import wave
+from piper import PiperConfig, PiperVoice
+import onnxruntime
+import struct
+import threading
 import json
-import base64
+import orjson
 
 load_dotenv()
 
@@ -18,11 +21,24 @@ app = FastAPI()
 _groq_api_key = os.getenv("GROQ_API_KEY")
 _n8n_webhook_url = os.getenv("N8N_WEBHOOK_URL")
 piper_model_path = os.getenv("PIPER_MODEL_PATH", "models/en_US-lessac-medium.onnx")
+piper_config_path = os.getenv("PIPER_CONFIG_PATH")
+# Split the cores between uvicorn CLI workers (uvicorn reads WEB_CONCURRENCY too).
+# `python main.py` always runs a single process, so it ignores WEB_CONCURRENCY.
+if __name__ == "__main__":
+    os.environ.pop("WEB_CONCURRENCY", None)
+web_concurrency = int(os.getenv("WEB_CONCURRENCY", "1"))
+piper_num_threads = int(os.getenv("PIPER_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // web_concurrency))))
 
 # Get absolute path relative to this file
 if not os.path.isabs(piper_model_path):
     piper_model_path = os.path.join(os.path.dirname(__file__), piper_model_path)
 
+# Config defaults to the file next to the model (a quantized model can reuse the original's)
+if not piper_config_path:
+    piper_config_path = f"{piper_model_path}.json"
+elif not os.path.isabs(piper_config_path):
+    piper_config_path = os.path.join(os.path.dirname(__file__), piper_config_path)
+
 if not _groq_api_key:
     raise ValueError("GROQ_API_KEY environment variable is required")
 if not _n8n_webhook_url:
@@ -32,7 +48,19 @@ if not _n8n_webhook_url:
 groq_api_key: str = _groq_api_key
 n8n_webhook_url: str = _n8n_webhook_url
 
-groq_client = Groq(api_key=groq_api_key)
+# Pooled HTTP/2 transport so concurrent STT requests share connections to Groq
+groq_client = AsyncGroq(
+    api_key=groq_api_key,
+    http_client=httpx.AsyncClient(
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=20,
+            max_connections=100,
+            keepalive_expiry=30.0
+        ),
+        http2=True
+    )
+)
 
 # Initialize Piper voice
 print(f"Loading Piper voice model from: {piper_model_path}")
@@ -42,64 +70,293 @@ if not os.path.exists(piper_model_path):
         "Run the download commands from the README to get the model files."
     )
 
-piper_voice = PiperVoice.load(piper_model_path)
+with open(piper_config_path, "r", encoding="utf-8") as config_file:
+    piper_config = PiperConfig.from_dict(json.load(config_file))
+
+# Prefer an accelerated execution provider when this onnxruntime build has one.
+# CUDA keeps Piper's HEURISTIC conv search: VITS input shapes change per sentence,
+# and the default EXHAUSTIVE search would re-benchmark for every new shape.
+_preferred_providers = [
+    ("CUDAExecutionProvider", {"cudnn_conv_algo_search": "HEURISTIC"}),
+    ("OpenVINOExecutionProvider", {}),
+    ("XnnpackExecutionProvider", {"intra_op_num_threads": str(piper_num_threads)}),
+]
+_available_providers = onnxruntime.get_available_providers()
+piper_providers = [p for p in _preferred_providers if p[0] in _available_providers]
+piper_providers.append(("CPUExecutionProvider", {}))
+_provider_names = [name for name, _ in piper_providers]
+print(f"Piper execution providers: {_provider_names}")
+
+# Build the ONNX Runtime session ourselves so it can be tuned
+session_options = onnxruntime.SessionOptions()
+session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+if "XnnpackExecutionProvider" in _provider_names:
+    # XNNPACK runs its own thread pool; keep ORT's from competing for the cores
+    session_options.intra_op_num_threads = 1
+    session_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+else:
+    session_options.intra_op_num_threads = piper_num_threads
+
+piper_voice = PiperVoice(
+    config=piper_config,
+    session=onnxruntime.InferenceSession(
+        piper_model_path,
+        sess_options=session_options,
+        providers=piper_providers
+    )
+)
+
+# Warm up so the first request doesn't pay for ONNX Runtime allocations
+for _ in piper_voice.synthesize("warmup."):
+    pass
 print(f"Piper voice loaded successfully!")
 
+# WebSocket audio is sent in fixed ~20 ms frames of 16-bit mono PCM
+FRAME_BYTES = int(0.02 * piper_voice.config.sample_rate) * 2
+
+# Sample rate, channels and width are fixed, so the WAV header is constant.
+# Size fields are 0xFFFFFFFF because streamed audio has no known length.
+WAV_STREAM_HEADER = struct.pack(
+    "<4sI4s4sIHHIIHH4sI",
+    b"RIFF", 0xFFFFFFFF, b"WAVE",
+    b"fmt ", 16, 1, 1,
+    piper_voice.config.sample_rate, piper_voice.config.sample_rate * 2, 2, 16,
+    b"data", 0xFFFFFFFF
+)
+
+
+def _produce(text, queue, loop, stop):
+    """Run Piper synthesis on a worker thread, feeding PCM chunks into queue"""
+    try:
+        for chunk in piper_voice.synthesize(text):
+            if stop.is_set():
+                break
+            # View the int16 array as raw bytes instead of copying via audio_int16_bytes
+            pcm = memoryview(chunk.audio_int16_array).cast("B")
+            asyncio.run_coroutine_threadsafe(queue.put(pcm), loop).result()
+    finally:
+        asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+
+# Synthesized PCM for recent replies, most recently used last.
+# Bounded by entry count and total bytes; long replies (~44 KB per second
+# of audio) are not cached at all.
+TTS_CACHE_SIZE = 256
+TTS_CACHE_MAX_BYTES = 32 * 1024 * 1024
+TTS_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+_tts_cache = OrderedDict()
+_tts_cache_bytes = 0
+
+
+async def synthesize_stream(text):
+    """
+    Yield PCM chunks for text while the next chunk is synthesized
+    on a worker thread, so sending and synthesis overlap.
+    Repeated replies are served from an LRU cache.
+    """
+    global _tts_cache_bytes
+    
+    cached = _tts_cache.get(text)
+    if cached is not None:
+        _tts_cache.move_to_end(text)
+        yield cached
+        return
+    
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=4)
+    stop = threading.Event()
+    producer = asyncio.create_task(
+        asyncio.to_thread(_produce, text, queue, loop, stop)
+    )
+    audio = bytearray()
+    
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            audio += item
+            yield item
+        
+        # Surface any synthesis error
+        await producer
+        
+        if len(audio) <= TTS_CACHE_MAX_ENTRY_BYTES and text not in _tts_cache:
+            _tts_cache[text] = bytes(audio)
+            _tts_cache_bytes += len(audio)
+            while len(_tts_cache) > TTS_CACHE_SIZE or _tts_cache_bytes > TTS_CACHE_MAX_BYTES:
+                _, evicted = _tts_cache.popitem(last=False)
+                _tts_cache_bytes -= len(evicted)
+    finally:
+        # Unblock the producer if the consumer stopped early
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+
+
+# While other STT batches are in flight, requests arriving within STT_MAX_WAIT
+# seconds are dispatched together; at most STT_MAX_BATCHES run at once
+STT_MAX_BATCH = 8
+STT_MAX_WAIT = 0.05
+STT_MAX_BATCHES = 4
+
+
+async def _run_stt_batch(batch, semaphore):
+    """Transcribe a batch of queued STT requests and resolve their futures"""
+    try:
+        results = await asyncio.gather(
+            *[
+                groq_client.audio.transcriptions.create(
+                    file=("audio.wav", audio_bytes),
+                    model="whisper-large-v3-turbo",
+                )
+                for audio_bytes, _ in batch
+            ],
+            return_exceptions=True
+        )
+    finally:
+        semaphore.release()
+    
+    for (_, future), result in zip(batch, results):
+        if future.done():  # Caller went away
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result.text)
+
+
+async def _stt_worker(queue):
+    """Gather STT requests that arrive close together and dispatch them as batches"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(STT_MAX_BATCHES)
+    in_flight = set()
+    
+    while True:
+        batch = [await queue.get()]
+        
+        # Only hold a request back for company when the server is already busy
+        if in_flight:
+            deadline = loop.time() + STT_MAX_WAIT
+            while len(batch) < STT_MAX_BATCH:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+        
+        await semaphore.acquire()
+        
+        # Pick up anything that arrived while waiting for a free slot
+        while len(batch) < STT_MAX_BATCH and not queue.empty():
+            batch.append(queue.get_nowait())
+        
+        task = asyncio.create_task(_run_stt_batch(batch, semaphore))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+
+async def transcribe(audio_bytes):
+    """Queue audio for STT with Groq and wait for its transcription"""
+    future = asyncio.get_running_loop().create_future()
+    await app.state.stt_queue.put((audio_bytes, future))
+    return await future
+
+
+async def send_message(websocket, payload):
+    """Send a JSON control message, encoded with orjson"""
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+
+# Audio format fields are fixed, so the audio control messages are serialized once.
+# Text frames are kept because binary frames carry audio.
+AUDIO_START_MESSAGE = orjson.dumps({
+    "type": "audio_start",
+    "sample_rate": piper_voice.config.sample_rate,
+    "channels": 1,
+    "sample_width": 2
+}).decode()
+_AUDIO_COMPLETE_PREFIX = (
+    '{"type":"audio_complete","sample_rate":%d,"channels":1,"sample_width":2,"total_chunks":'
+    % piper_voice.config.sample_rate
+)
+
+
 # Default session ID for testing (in production, this would come from the client)
 DEFAULT_SESSION_ID = "test-user-001"
 
+# Largest audio upload accepted (Groq's STT file limit)
+MAX_AUDIO_BYTES = 25 * 1024 * 1024
+
+# WebSocket protocol limit, kept above MAX_AUDIO_BYTES so oversized uploads get
+# an "Audio too large" error; anything beyond this is closed with code 1009
+WS_MAX_MESSAGE_BYTES = MAX_AUDIO_BYTES + 1024 * 1024
+
+
+@app.on_event("startup")
+async def startup():
+    """
+    Create a shared HTTP client so n8n calls reuse keepalive connections,
+    and start the STT batching worker
+    """
+    app.state.http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=40,
+            max_connections=100,
+            keepalive_expiry=30.0
+        )
+    )
+    
+    app.state.stt_queue = asyncio.Queue()
+    app.state.stt_worker = asyncio.create_task(_stt_worker(app.state.stt_queue))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.stt_worker.cancel()
+    await groq_client.close()
+    await app.state.http_client.aclose()
+
 
 @app.post("/process-voice")
 async def process_voice(audio: UploadFile = File(...)):
-    """HTTP endpoint - returns complete audio file"""
+    """HTTP endpoint - streams the audio file as it is synthesized"""
+    # Reject oversized uploads before reading them into memory
+    if (audio.size or 0) > MAX_AUDIO_BYTES:
+        raise HTTPException(status_code=413, detail="Audio too large")
+    
     try:
         # Step 1: Read audio file
         audio_bytes = await audio.read()
         
         # Step 2: STT with Groq
-        transcription = groq_client.audio.transcriptions.create(
-            file=("audio.wav", audio_bytes),
-            model="whisper-large-v3-turbo",
-        )
-        text = transcription.text
+        text = await transcribe(audio_bytes)
         
         # Step 3: Send to n8n
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            n8n_response = await client.post(
-                n8n_webhook_url,
-                json={
-                    "chatInput": text,
-                    "sessionId": DEFAULT_SESSION_ID
-                }
-            )
-            n8n_response.raise_for_status()
-            response_data = n8n_response.json()
-            
-            # Extract response from n8n's nested structure
-            response_text = response_data["response"]["output"]
-        
-        # Step 4: TTS with Piper
-        audio_chunks = []
-        for chunk in piper_voice.synthesize(response_text):
-            audio_chunks.append(chunk.audio_int16_bytes)
-        
-        audio_data = b''.join(audio_chunks)
+        n8n_response = await app.state.http_client.post(
+            n8n_webhook_url,
+            json={
+                "chatInput": text,
+                "sessionId": DEFAULT_SESSION_ID
+            }
+        )
+        n8n_response.raise_for_status()
+        response_data = n8n_response.json()
         
-        # Step 5: Create WAV file in memory
-        audio_buffer = io.BytesIO()
-        with wave.open(audio_buffer, "wb") as wav_file:
-            wav_file.setnchannels(1)  # Mono
-            wav_file.setsampwidth(2)  # 16-bit
-            wav_file.setframerate(piper_voice.config.sample_rate)
-            wav_file.writeframes(audio_data)
+        # Extract response from n8n's nested structure
+        response_text = response_data["response"]["output"]
         
-        audio_buffer.seek(0)
+        # Step 4: TTS with Piper - stream PCM as each chunk is synthesized
+        async def gen():
+            yield WAV_STREAM_HEADER
+            async for pcm in synthesize_stream(response_text):
+                yield pcm
         
-        # Step 6: Return audio
-        return Response(
-            content=audio_buffer.read(),
-            media_type="audio/wav"
-        )
+        # Step 5: Return audio
+        return StreamingResponse(gen(), media_type="audio/wav")
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -112,90 +369,137 @@ async def websocket_process_voice(websocket: WebSocket):
     
     Protocol:
     1. Client connects
-    2. Client sends: {"audio": "<base64_encoded_audio>", "sessionId": "optional"}
-    3. Server sends: {"type": "transcription", "text": "..."}
-    4. Server sends: {"type": "ai_response", "text": "..."}
-    5. Server streams: {"type": "audio_chunk", "data": "<base64_audio>", "index": N}
-    6. Server sends: {"type": "audio_complete", "sample_rate": 22050}
-    7. Connection closes or waits for next audio
+    2. Client optionally sends: {"sessionId": "..."} (kept for the rest of the connection)
+    3. Client sends: binary frame with the raw WAV audio
+    4. Server sends: {"type": "transcription", "text": "..."}
+    5. Server sends: {"type": "ai_response", "text": "..."}
+    6. Server sends: {"type": "audio_start", "sample_rate": 22050, "channels": 1, "sample_width": 2}
+    7. Server streams: binary frames of raw 16-bit PCM audio (~20 ms each)
+    8. Server sends: {"type": "audio_complete", "total_chunks": N, "sample_rate": 22050}
+    9. Connection closes or waits for next audio
     """
     await websocket.accept()
+    session_id = DEFAULT_SESSION_ID
     
     try:
         while True:
-            # Receive audio from client
-            data = await websocket.receive_json()
+            # Receive session metadata (text) or raw audio (binary) from client
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
             
-            # Extract audio and session ID
-            audio_base64 = data.get("audio")
-            session_id = data.get("sessionId", DEFAULT_SESSION_ID)
+            if message.get("text") is not None:
+                try:
+                    data = orjson.loads(message["text"])
+                except orjson.JSONDecodeError:
+                    data = None
+                
+                if not isinstance(data, dict):
+                    await send_message(websocket, {
+                        "type": "error",
+                        "message": "Text messages must be a JSON object"
+                    })
+                    continue
+                
+                # Old protocol sent base64 audio inside JSON
+                if "audio" in data:
+                    await send_message(websocket, {
+                        "type": "error",
+                        "message": "Send audio as a binary frame"
+                    })
+                    continue
+                
+                session_id = data.get("sessionId", session_id)
+                continue
             
-            if not audio_base64:
-                await websocket.send_json({
+            audio_bytes = message.get("bytes")
+            
+            if not audio_bytes:
+                await send_message(websocket, {
                     "type": "error",
                     "message": "No audio data provided"
                 })
                 continue
             
-            # Decode audio
-            audio_bytes = base64.b64decode(audio_base64)
+            if len(audio_bytes) > MAX_AUDIO_BYTES:
+                await send_message(websocket, {
+                    "type": "error",
+                    "message": "Audio too large"
+                })
+                continue
             
             try:
                 # Step 1: STT with Groq
-                transcription = groq_client.audio.transcriptions.create(
-                    file=("audio.wav", audio_bytes),
-                    model="whisper-large-v3-turbo",
-                )
-                text = transcription.text
+                text = await transcribe(audio_bytes)
                 
-                # Send transcription to client
-                await websocket.send_json({
-                    "type": "transcription",
-                    "text": text
-                })
-                
-                # Step 2: Send to n8n
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    n8n_response = await client.post(
+                # Send transcription to client while the n8n request is in flight
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(send_message(websocket, {
+                        "type": "transcription",
+                        "text": text
+                    }))
+                    
+                    # Step 2: Send to n8n
+                    n8n_task = tg.create_task(app.state.http_client.post(
                         n8n_webhook_url,
                         json={
                             "chatInput": text,
                             "sessionId": session_id
                         }
-                    )
-                    n8n_response.raise_for_status()
-                    response_data = n8n_response.json()
-                    response_text = response_data["response"]["output"]
+                    ))
                 
-                # Send AI response text to client
-                await websocket.send_json({
-                    "type": "ai_response",
-                    "text": response_text
-                })
+                n8n_response = n8n_task.result()
+                n8n_response.raise_for_status()
+                response_data = n8n_response.json()
+                response_text = response_data["response"]["output"]
                 
-                # Step 3: TTS with Piper - stream chunks
-                chunk_index = 0
-                for chunk in piper_voice.synthesize(response_text):
-                    # Send each audio chunk immediately
-                    audio_chunk_base64 = base64.b64encode(chunk.audio_int16_bytes).decode('utf-8')
-                    await websocket.send_json({
-                        "type": "audio_chunk",
-                        "data": audio_chunk_base64,
-                        "index": chunk_index
-                    })
+                # Step 3: TTS with Piper - stream chunks as binary frames
+                audio_stream = synthesize_stream(response_text)
+                try:
+                    # Send AI response text to client while Piper starts synthesizing
+                    async with asyncio.TaskGroup() as tg:
+                        tg.create_task(send_message(websocket, {
+                            "type": "ai_response",
+                            "text": response_text
+                        }))
+                        first_task = tg.create_task(anext(audio_stream, None))
+                    
+                    await websocket.send_text(AUDIO_START_MESSAGE)
+                    
+                    chunk_index = 0
+                    buffer = bytearray()
+                    pcm = first_task.result()
+                    while pcm is not None:
+                        # Coalesce Piper output into fixed-size frames
+                        buffer += pcm
+                        
+                        # Copy each frame straight out of the buffer, then drop
+                        # the sent bytes once instead of shifting per frame
+                        offset = 0
+                        with memoryview(buffer) as view:
+                            while len(buffer) - offset >= FRAME_BYTES:
+                                await websocket.send_bytes(bytes(view[offset:offset + FRAME_BYTES]))
+                                offset += FRAME_BYTES
+                                chunk_index += 1
+                        del buffer[:offset]
+                        
+                        pcm = await anext(audio_stream, None)
+                finally:
+                    await audio_stream.aclose()
+                
+                # Flush the remaining partial frame
+                if buffer:
+                    await websocket.send_bytes(bytes(buffer))
                     chunk_index += 1
                 
                 # Send completion message
-                await websocket.send_json({
-                    "type": "audio_complete",
-                    "total_chunks": chunk_index,
-                    "sample_rate": piper_voice.config.sample_rate,
-                    "channels": 1,
-                    "sample_width": 2
-                })
+                await websocket.send_text(f"{_AUDIO_COMPLETE_PREFIX}{chunk_index}}}")
                 
             except Exception as e:
-                await websocket.send_json({
+                # Report the underlying error rather than the TaskGroup wrapper
+                if isinstance(e, ExceptionGroup):
+                    e = e.exceptions[0]
+                await send_message(websocket, {
                     "type": "error",
                     "message": str(e)
                 })
@@ -205,7 +509,7 @@ async def websocket_process_voice(websocket: WebSocket):
     except Exception as e:
         print(f"WebSocket error: {e}")
         try:
-            await websocket.send_json({
+            await send_message(websocket, {
                 "type": "error",
                 "message": str(e)
             })
@@ -215,4 +519,16 @@ async def websocket_process_voice(websocket: WebSocket):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Single process: workers need the uvicorn CLI (see README), since spawned
+    # children would re-run this script and load Piper a second time.
+    # Audio travels as raw PCM/WAV binary frames, which don't compress well.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_per_message_deflate=False,
+        ws_max_size=WS_MAX_MESSAGE_BYTES
+    )
\ No newline at end of file
@@ -1,7 +1,8 @@
 import asyncio
+import collections
+import threading
 import websockets
-import json
-import base64
+import orjson
 import wave
 import io
 import pyaudio
@@ -10,7 +11,7 @@ class VoiceAssistantClient:
     def __init__(self, server_url="ws://localhost:8000/ws/process-voice", session_id="pi-001"):
         self.server_url = server_url
         self.session_id = session_id
-        self.audio_chunks = []
+        self.audio_buffer = bytearray()
         self.sample_rate = 22050
         
     async def connect_and_process(self, audio_file_path):
@@ -24,24 +25,26 @@ class VoiceAssistantClient:
         with open(audio_file_path, "rb") as f:
             audio_bytes = f.read()
         
-        # Encode to base64
-        audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
-        
         async with websockets.connect(self.server_url) as websocket:
             print("Connected to server")
             
-            # Send audio
-            await websocket.send(json.dumps({
-                "audio": audio_base64,
+            # Send session metadata, then the raw audio as a binary frame
+            await websocket.send(orjson.dumps({
                 "sessionId": self.session_id
-            }))
+            }).decode())
+            await websocket.send(audio_bytes)
             print("Audio sent, waiting for response...")
             
-            self.audio_chunks = []
+            self.audio_buffer = bytearray()
             
             # Receive responses
             async for message in websocket:
-                data = json.loads(message)
+                if isinstance(message, bytes):
+                    # Binary frames are raw PCM audio chunks
+                    self.audio_buffer.extend(message)
+                    continue
+                
+                data = orjson.loads(message)
                 msg_type = data.get("type")
                 
                 if msg_type == "transcription":
@@ -50,11 +53,8 @@ class VoiceAssistantClient:
                 elif msg_type == "ai_response":
                     print(f"[AI Response] {data['text']}")
                 
-                elif msg_type == "audio_chunk":
-                    # Decode and store audio chunk
-                    chunk_data = base64.b64decode(data["data"])
-                    self.audio_chunks.append(chunk_data)
-                    print(f"[Audio Chunk] Received chunk {data['index']}")
+                elif msg_type == "audio_start":
+                    self.sample_rate = data["sample_rate"]
                 
                 elif msg_type == "audio_complete":
                     print(f"[Complete] Received {data['total_chunks']} chunks")
@@ -73,20 +73,16 @@ class VoiceAssistantClient:
                     break
     
     def save_audio(self, filename):
-        """Save received audio chunks to WAV file"""
-        audio_data = b''.join(self.audio_chunks)
-        
+        """Save received audio to WAV file"""
         with wave.open(filename, "wb") as wav_file:
             wav_file.setnchannels(1)  # Mono
             wav_file.setsampwidth(2)  # 16-bit
             wav_file.setframerate(self.sample_rate)
-            wav_file.writeframes(audio_data)
+            wav_file.writeframes(self.audio_buffer)
     
     def play_audio(self):
         """Play the received audio"""
         try:
-            audio_data = b''.join(self.audio_chunks)
-            
             p = pyaudio.PyAudio()
             stream = p.open(
                 format=pyaudio.paInt16,
@@ -96,7 +92,7 @@ class VoiceAssistantClient:
             )
             
             print("Playing audio...")
-            stream.write(audio_data)
+            stream.write(bytes(self.audio_buffer))
             
             stream.stop_stream()
             stream.close()
@@ -115,8 +111,13 @@ class StreamingVoiceAssistantClient:
     def __init__(self, server_url="ws://localhost:8000/ws/process-voice", session_id="pi-001"):
         self.server_url = server_url
         self.session_id = session_id
-        self.audio_queue = asyncio.Queue()
         self.playback_started = False
+        # Filled by the receive loop, drained by PyAudio's callback thread
+        self.playback_chunks = collections.deque()
+        self.playback_lock = threading.Lock()
+        self.playback_finished = False
+        self.pyaudio = None
+        self.stream = None
         
     async def connect_and_process(self, audio_file_path):
         """Connect and process with streaming playback"""
@@ -124,24 +125,27 @@ class StreamingVoiceAssistantClient:
         with open(audio_file_path, "rb") as f:
             audio_bytes = f.read()
         
-        audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
-        
         async with websockets.connect(self.server_url) as websocket:
             print("Connected to server")
             
-            # Send audio
-            await websocket.send(json.dumps({
-                "audio": audio_base64,
+            # Send session metadata, then the raw audio as a binary frame
+            await websocket.send(orjson.dumps({
                 "sessionId": self.session_id
-            }))
+            }).decode())
+            await websocket.send(audio_bytes)
             print("Audio sent, waiting for response...")
             
-            # Start playback task
-            playback_task = asyncio.create_task(self.play_audio_stream())
-            
-            # Receive and queue audio chunks
+            # Receive audio chunks straight into the playback buffer
             async for message in websocket:
-                data = json.loads(message)
+                if isinstance(message, bytes):
+                    with self.playback_lock:
+                        self.playback_chunks.append(message)
+                    if not self.playback_started:
+                        print("[Streaming] Starting playback...")
+                        self.playback_started = True
+                    continue
+                
+                data = orjson.loads(message)
                 msg_type = data.get("type")
                 
                 if msg_type == "transcription":
@@ -150,52 +154,81 @@ class StreamingVoiceAssistantClient:
                 elif msg_type == "ai_response":
                     print(f"[AI Response] {data['text']}")
                 
-                elif msg_type == "audio_chunk":
-                    # Decode and queue audio chunk for immediate playback
-                    chunk_data = base64.b64decode(data["data"])
-                    await self.audio_queue.put(chunk_data)
-                    if not self.playback_started:
-                        print("[Streaming] Starting playback...")
-                        self.playback_started = True
+                elif msg_type == "audio_start":
+                    self.open_playback_stream(data["sample_rate"])
                 
                 elif msg_type == "audio_complete":
                     print(f"[Complete] Received {data['total_chunks']} chunks")
-                    # Signal end of stream
-                    await self.audio_queue.put(None)
                     break
                 
                 elif msg_type == "error":
                     print(f"[Error] {data['message']}")
-                    await self.audio_queue.put(None)
                     break
             
-            # Wait for playback to finish
-            await playback_task
+            # Signal end of stream and wait for playback to finish
+            with self.playback_lock:
+                self.playback_finished = True
+            await self.wait_for_playback()
+    
+    def _playback_callback(self, in_data, frame_count, time_info, status):
+        """PyAudio callback - pulls queued audio without blocking the event loop"""
+        needed = frame_count * 2  # 16-bit mono
+        out = bytearray()
+        
+        with self.playback_lock:
+            while self.playback_chunks and len(out) < needed:
+                chunk = self.playback_chunks.popleft()
+                take = needed - len(out)
+                out += chunk[:take]
+                if len(chunk) > take:
+                    self.playback_chunks.appendleft(chunk[take:])
+            finished = self.playback_finished and not self.playback_chunks
+        
+        # Pad underruns with silence
+        if len(out) < needed:
+            out += bytes(needed - len(out))
+        
+        return bytes(out), pyaudio.paComplete if finished else pyaudio.paContinue
     
-    async def play_audio_stream(self):
-        """Play audio chunks as they arrive"""
+    def open_playback_stream(self, sample_rate):
+        """Open a callback-driven output stream at the server's sample rate"""
         try:
-            p = pyaudio.PyAudio()
-            stream = p.open(
+            with self.playback_lock:
+                self.playback_finished = False
+            
+            self.pyaudio = pyaudio.PyAudio()
+            self.stream = self.pyaudio.open(
                 format=pyaudio.paInt16,
                 channels=1,
-                rate=22050,
-                output=True
+                rate=sample_rate,
+                output=True,
+                frames_per_buffer=1024,
+                stream_callback=self._playback_callback
             )
             
-            while True:
-                chunk = await self.audio_queue.get()
-                if chunk is None:  # End of stream
-                    break
-                stream.write(chunk)
+        except Exception as e:
+            print(f"Playback error: {e}")
+    
+    async def wait_for_playback(self):
+        """Let the callback drain what's left, then close the stream"""
+        try:
+            if self.stream is not None:
+                while self.stream.is_active():
+                    await asyncio.sleep(0.05)
+                
+                self.stream.stop_stream()
+                self.stream.close()
+                print("[Streaming] Playback complete")
             
-            stream.stop_stream()
-            stream.close()
-            p.terminate()
-            print("[Streaming] Playback complete")
+            if self.pyaudio is not None:
+                self.pyaudio.terminate()
             
         except Exception as e:
             print(f"Playback error: {e}")
+        
+        finally:
+            self.stream = None
+            self.pyaudio = None
 
 
 # Example usage